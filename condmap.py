@@ -1,13 +1,40 @@
 from parser import Parsed
-from line_types import Line, State, StateType, StateSubtype, StateStack
-from typing import Optional, List, Set
+from line_types import Line, State, StateType, StateSubtype, StateStack, VALID_SUBTYPES, NONTEXT_TYPES
+from typing import Optional, List, Set, Dict
 from enum import Enum, auto
 from dataclasses import dataclass
+import bisect
 import logging
 import regexes
 
 logger = logging.getLogger(__name__)
 
+# list item subtypes that do NOT make a conditional starting on them a partial
+_PARTIAL_LIST_ITEM_SUBTYPES = frozenset({StateSubtype.FIRST_LINE, StateSubtype.TERMINATED,
+                                         StateSubtype.JOINED_DELIMITED_BLOCK})
+
+class _StartPosition(Enum):
+    """Where the first conditioned line sits, judged from its top state alone"""
+    MID_ITEM = auto() # inside a paragraph or list item - can only be a partial
+    LIST_ITEM_START = auto() # the first line of a list item
+    BLOCK_START = auto() # anything else - the start of a block, paragraph, list...
+
+def _start_position(type: StateType, subtype: StateSubtype) -> _StartPosition:
+    if (type, subtype) == (StateType.PARAGRAPH, StateSubtype.NORMAL):
+        return _StartPosition.MID_ITEM
+    if type == StateType.LIST_ITEM:
+        if subtype == StateSubtype.FIRST_LINE:
+            return _StartPosition.LIST_ITEM_START
+        if subtype not in _PARTIAL_LIST_ITEM_SUBTYPES:
+            return _StartPosition.MID_ITEM
+    return _StartPosition.BLOCK_START
+
+# decision table for every valid (type, subtype) of the first conditioned line, built once
+_START_POSITIONS: Dict[tuple, _StartPosition] = {
+    (type, subtype): _start_position(type, subtype)
+    for type, subtypes in VALID_SUBTYPES.items() for subtype in subtypes
+}
+
 class ConditionalType(Enum):
     """ types of conditionals 
         note absence of INVALID - invalid conditionals are just not processed"""
@@ -19,6 +46,8 @@ class ConditionalType(Enum):
 
 @dataclass
 class Conditional:
+    # explicit __slots__ rather than dataclass(slots=True), which needs Python 3.10
+    __slots__ = ('type', 'start_id', 'end_id', 'values')
     type: ConditionalType
     start_id: int
     end_id: int
@@ -26,13 +55,37 @@ class Conditional:
 
 
 class ConditionalsMap:
-    conditionals: List[Conditional] = [] # type hint for IDE
     def __init__(self, parsed: Parsed, values: Set[str]):
         self.parsed = parsed
-        self.conditionals = []
-        self.values = values
+        # the parsed document is not changed while the map is made, so the list of lines
+        # can be taken once; the position of a line comes from parsed.index(), which stays
+        # valid for the same reason
+        self._lines: List[Line] = parsed.lines
+        # flag for every line index: 1 if the line is blank, a conditional, a comment or an attribute definition
+        self._skippable = bytearray(len(self._lines))
+        # indices of all conditional marker lines (start, end, single line), in document order
+        self._cond_indices: List[int] = []
+        for i, line in enumerate(self._lines):
+            top_type = line.state_stack.top().type
+            if line.is_blank or top_type in NONTEXT_TYPES:
+                self._skippable[i] = 1
+            if top_type == StateType.CONDITIONAL:
+                self._cond_indices.append(i)
+        self.conditionals: List[Conditional] = []
+        self.values = frozenset(values)
         self._make_map()
 
+    def _next_content_line(self, line: Line) -> Optional[Line]:
+        """Get the first line after this one that is not blank, a conditional, a comment
+           or an attribute definition. Returns None if there is no such line."""
+        i = self.parsed.index(line) + 1
+        lines = self._lines
+        n = len(lines)
+        skippable = self._skippable
+        while i < n and skippable[i]:
+            i += 1
+        return lines[i] if i < n else None
+
     def pretty(self) -> str:
         """Return a pretty-printed representation of the conditionals map"""
         if not self.conditionals:
@@ -55,37 +108,50 @@ class ConditionalsMap:
         end_idx = self.parsed.index(end_line)
         if end_idx < start_idx:
             raise RuntimeError(f"_warn_about_nested called with start_idx {start_idx} > end_idx {end_idx}")
+        # local names for the enum members used in the loop
+        conditional_type = StateType.CONDITIONAL
+        section_header_type = StateType.SECTION_HEADER
+        end_subtype = StateSubtype.END
+        lines = self._lines
         idx = start_idx
         while idx <= end_idx:
-            line = self.parsed.lines[idx]
-            if (line.state_stack.top().type == StateType.CONDITIONAL and 
-                line.state_stack.top().subtype != StateSubtype.END):
+            line = lines[idx]
+            top = line.state_stack.top()
+            if top.type == conditional_type and top.subtype != end_subtype:
                 logger.warning(f"Conditional at line {line.id} is nested - unsupported")
-            if line.state_stack.top().type == StateType.SECTION_HEADER:
+            if top.type == section_header_type:
                 logger.warning(f"Section header confitioned at line {line.id} - result is uncertain!")
             idx += 1
 
 
     def _make_map(self):
+        debug_on = logger.isEnabledFor(logging.DEBUG)
         idx = 0
-        end_ids_unsupported = []
-        while idx < len(self.parsed.lines):
-            start_line: Line = self.parsed.lines[idx]
-
-            logger.debug(f"Processing line index {idx}, id {start_line.id}")
+        end_ids_unsupported = set()
+        cond_indices = self._cond_indices
+        cond_pos = 0
+        while True:
+            # lines that are not conditional markers are of no interest here,
+            # so jump straight to the first conditional marker at or after idx
+            cond_pos = bisect.bisect_left(cond_indices, idx, cond_pos)
+            if cond_pos == len(cond_indices):
+                break
+            idx = cond_indices[cond_pos]
+            start_line: Line = self._lines[idx]
+
+            if debug_on:
+                logger.debug("Processing line index %s, id %s", idx, start_line.id)
 
             top_state = start_line.state_stack.top()
-            if top_state.type != StateType.CONDITIONAL:
-                # the line is not a conditional marker and we are outside any conditional markers
-                idx+=1
-                continue
 
-            logger.debug(f"  Found conditional at line {start_line.id}")
+            if debug_on:
+                logger.debug("  Found conditional at line %s", start_line.id)
 
             # at this point the line at idx is a conditional
             # if it is a single-line - ignore with a warning
             if top_state.subtype == StateSubtype.SINGLE_LINE:
-                logger.debug(f"  Skipping SINGLE_LINE conditional")
+                if debug_on:
+                    logger.debug("  Skipping SINGLE_LINE conditional")
                 logger.warning(f"Single-line conditional ignored, line {start_line.id}")
                 idx+=1
                 continue
@@ -94,10 +160,12 @@ class ConditionalsMap:
             # ...except if this is the end of an unsupported conditional, just skip it
             if top_state.subtype == StateSubtype.END:
                 if not start_line.id in end_ids_unsupported:
-                    logger.debug(f"  Unmatched END conditional")
+                    if debug_on:
+                        logger.debug("  Unmatched END conditional")
                     logger.warning(f"endif encountered with no pair, line {start_line.id}")
                 else:
-                    logger.debug(f"  Skipping END of unsupported conditional")
+                    if debug_on:
+                        logger.debug("  Skipping END of unsupported conditional")
                 idx+=1
                 continue
 
@@ -112,34 +180,37 @@ class ConditionalsMap:
             # if it is an ifeval, it is not supported
             operator = top_state.get("operator")
             if operator == "ifeval":
-                logger.debug(f"  Skipping ifeval (unsupported)")
+                if debug_on:
+                    logger.debug("  Skipping ifeval (unsupported)")
                 logger.warning(f"ifeval is unsupported, line {start_line.id}")
-                end_ids_unsupported.append(end_line_id)
+                end_ids_unsupported.add(end_line_id)
                 idx+=1
                 continue
 
             # parse the expression now
             expression = top_state.get("expression")
             if not expression:
-                logger.debug(f"  Skipping (no expression)")
+                if debug_on:
+                    logger.debug("  Skipping (no expression)")
                 logger.warning(f"could not get the expression for ifdef/endif, line {start_line.id}")
-                end_ids_unsupported.append(end_line_id)
+                end_ids_unsupported.add(end_line_id)
                 idx+=1
                 continue
 
-            logger.debug(f"  Processing {operator}::{expression}[], lines {start_line.id}-{end_line_id}")
+            if debug_on:
+                logger.debug("  Processing %s::%s[], lines %s-%s", operator, expression, start_line.id, end_line_id)
             # if a + is used: we don't support this logic currently
             if "+" in expression:
                 logger.warning(f"ifdef/ifndef expression using + unsupported, line {start_line.id}")
-                end_ids_unsupported.append(end_line_id)
+                end_ids_unsupported.add(end_line_id)
                 idx+=1
                 continue
 
             # now the expression should be just one attribute or a few split by "," 
-            condition_values=set([attr.strip() for attr in expression.split(",") if attr.strip()])
+            condition_values = {attr.strip() for attr in expression.split(",") if attr.strip()}
             if not condition_values.issubset(self.values):
                 logger.warning(f"ifdef/ifndef expression {expression} uses undefined value - unsupported, line {start_line.id}")
-                end_ids_unsupported.append(end_line_id)
+                end_ids_unsupported.add(end_line_id)
                 idx+=1
                 continue
             # revert the values if ifndef
@@ -147,16 +218,17 @@ class ConditionalsMap:
                 condition_values = self.values - condition_values
 
             # if the delimited block stack situation is different, unsupported
-            if start_line.state_stack.until_delim_or_root() != end_line.state_stack.until_delim_or_root():
-                logger.debug(f"  Skipping (crosses delimited block boundary)")
+            if start_line.delim_or_root_prefix() != end_line.delim_or_root_prefix():
+                if debug_on:
+                    logger.debug("  Skipping (crosses delimited block boundary)")
                 logger.warning(f"lines {start_line.id} and {end_line_id} are in different delimited block positions - unsupported")
-                end_ids_unsupported.append(end_line_id)
+                end_ids_unsupported.add(end_line_id)
                 idx+=1
                 continue
 
 
             # check what is in the PREVIOUS line
-            prev_line = self.parsed.previous_line(start_line)
+            prev_line = start_line.prev
             if prev_line: # note it might be None in case the conditional starts on line 1
                 prev_line_top_state = prev_line.state_stack.top()
                 # if it is a block attribute line - no support; 
@@ -164,25 +236,25 @@ class ConditionalsMap:
                 if prev_line_top_state.type == StateType.BLOCK_PREFIX:
                     if prev_line_top_state.subtype == StateSubtype.BLOCK_ATTRIBUTES:
                         logger.warning(f"[Block attributes] immediately before conditional at line {start_line.id} - unsupported")
-                        end_ids_unsupported.append(end_line_id)
+                        end_ids_unsupported.add(end_line_id)
                         idx+=1
                         continue
                     if prev_line_top_state.subtype == StateSubtype.BLOCK_TITLE:
-                        next_line = self.parsed.next_line(start_line)
+                        next_line = start_line.next
                         if next_line.state_stack.top().type == StateType.DELIMITED_BLOCK:
                             logger.warning(f"Conditional cuts .BlockTitle off delimited block at line {start_line.id} - unsupported")
-                            end_ids_unsupported.append(end_line_id)
+                            end_ids_unsupported.add(end_line_id)
                             idx+=1
                             continue
         
             # get the first and last lines within the conditioned block, first check for empty
-            first_line = self.parsed.next_line(start_line)
+            first_line = start_line.next
             if first_line == end_line:
                 logger.warning(f"Empty conditional at line {start_line.id} - unsupported")
                 # just skip past the end
                 idx = self.parsed.index(end_line)+1
                 continue
-            last_line = self.parsed.previous_line(end_line)
+            last_line = end_line.prev
             # note that first_line and last_line CAN be the same, the subsequent logic should be robust to this
             first_line_top_state = first_line.state_stack.top()
             last_line_top_state = last_line.state_stack.top()
@@ -190,23 +262,18 @@ class ConditionalsMap:
             # find the last NON-BLANK line - important for evaluating partials
             # TODO: this logic is NOT robust to comments in some places
             last_non_blank_line = last_line
-            while last_non_blank_line.content.strip() == "":
+            while last_non_blank_line.is_blank:
                 if last_non_blank_line == first_line:
                     logger.warning(f"Conditional of blanks at line {idx} - unsupported")
                     # just skip past the end
                     idx = self.parsed.index(end_line)+1
                     continue
-                last_non_blank_line = self.parsed.previous_line(last_non_blank_line)
+                last_non_blank_line = last_non_blank_line.prev
 
             # for several cases we want to know the next line 
             # (that is not a conditional or attribute line or comment or blank) 
             # note the line might not even exist (end of file)
-            next_line = self.parsed.next_line(end_line)
-            while (next_line and ((next_line.content.strip() =="") or
-                next_line.state_stack.top().type in [StateType.CONDITIONAL,
-                                                    StateType.LINE_COMMENT,
-                                                    StateType.ATTRIBUTE_DEFINITION])):
-                next_line = self.parsed.next_line(next_line)
+            next_line = self._next_content_line(end_line)
             if next_line:
                 next_line_state_stack = next_line.state_stack.duplicate()
             else:
@@ -214,19 +281,17 @@ class ConditionalsMap:
 
 
 
+            start_position = _START_POSITIONS[(first_line_top_state.type, first_line_top_state.subtype)]
+
             # Process a partial that is clearly a partial from the start side
             # So mid-paragraph or mid-list-item
-            if (((first_line_top_state.type,first_line_top_state.subtype) ==
-                 (StateType.PARAGRAPH, StateSubtype.NORMAL)) or (
-                     first_line_top_state.type == StateType.LIST_ITEM and
-                     not first_line_top_state.subtype in [StateSubtype.FIRST_LINE,
-                                                          StateSubtype.TERMINATED,
-                                                           StateSubtype.JOINED_DELIMITED_BLOCK ])):
+            if start_position == _StartPosition.MID_ITEM:
                  # TODO this makes starting/ending on a joiner unsupported, maybe add some way for it
 
                  # this works as a partial if the last non-blank line has the exact same state
                  if first_line.state_stack == last_non_blank_line.state_stack :
-                    logger.debug(f"  Classified as PARTIAL: lines {start_line.id}-{end_line_id}")
+                    if debug_on:
+                        logger.debug("  Classified as PARTIAL: lines %s-%s", start_line.id, end_line_id)
                     cond = Conditional(type = ConditionalType.PARTIAL,
                                         start_id = start_line.id,
                                         end_id = end_line_id,
@@ -237,7 +302,7 @@ class ConditionalsMap:
                     continue
                  else:
                     logger.warning(f"Conditional starts mid-paragraph/list item and includes several items, lines {start_line.id}  - unsupported")
-                    end_ids_unsupported.append(end_line_id)
+                    end_ids_unsupported.add(end_line_id)
                     idx+=1
                     continue 
 
@@ -245,8 +310,7 @@ class ConditionalsMap:
             # and the last line is still in the same item and is not blank
             # they are special because they can lead into the grouped special case
             # we also detect the group special case here
-            if (((first_line_top_state.type,first_line_top_state.subtype) == 
-                (StateType.LIST_ITEM, StateSubtype.FIRST_LINE)) and 
+            if ((start_position == _StartPosition.LIST_ITEM_START) and
                 (last_line_top_state == first_line_top_state)): 
 
                 # we already know the last conditioned ine is in this same list item
@@ -255,12 +319,7 @@ class ConditionalsMap:
                 # is parsed as a part of this same list item
                 # note the line ight not even exist (end of file) in which cases this is
                 # a complete list item
-                next_line = self.parsed.next_line(end_line)
-                while (next_line and ((next_line.content.strip() =="") or
-                   next_line.state_stack.top().type in [StateType.CONDITIONAL,
-                                                        StateType.LINE_COMMENT,
-                                                        StateType.ATTRIBUTE_DEFINITION])):
-                    next_line = self.parsed.next_line(next_line)
+                # (next_line and next_line_state_stack were already found above)
 
                 part_start_list_item = False
 
@@ -274,7 +333,8 @@ class ConditionalsMap:
                             part_start_list_item = True
 
                 if not part_start_list_item:
-                    logger.debug(f"  Classified as SINGLE_LIST_ITEM: lines {start_line.id}-{end_line_id}")
+                    if debug_on:
+                        logger.debug("  Classified as SINGLE_LIST_ITEM: lines %s-%s", start_line.id, end_line_id)
                     cond = Conditional(type = ConditionalType.SINGLE_LIST_ITEM,
                                         start_id = start_line.id,
                                         end_id = end_line_id,
@@ -285,22 +345,22 @@ class ConditionalsMap:
                     continue
                 # we do have a partial start of list item - work out if there are grouped versions
                 # a group must have strictly no lines in between conditionals
-                # this allows us a backward pass on self.conditionals with strict criteria
+                # so only the last conditional found so far can be the one immediately before this one
                 group = False
-                potential_last_line_id = self.parsed.previous_line(start_line).id
-                for cond_idx in range(len(self.conditionals)-1,-1,-1):
-                    if self.conditionals[cond_idx].end_id != potential_last_line_id:
-                        break
-                    if self.conditionals[cond_idx].type != ConditionalType.SINGLE_LIST_ITEM:
-                        break
-                    group = True
-                    self.conditionals[cond_idx].type = ConditionalType.GROUP_START_LIST_ITEM
+                potential_last_line_id = start_line.prev.id
+                if self.conditionals:
+                    last_cond = self.conditionals[-1]
+                    if (last_cond.end_id == potential_last_line_id and
+                        last_cond.type == ConditionalType.SINGLE_LIST_ITEM):
+                        group = True
+                        last_cond.type = ConditionalType.GROUP_START_LIST_ITEM
                 if group:
                     type = ConditionalType.GROUP_START_LIST_ITEM
                 else:
                     type = ConditionalType.PART_START_LIST_ITEM
 
-                logger.debug(f"  Classified as {type.name}: lines {start_line.id}-{end_line_id}")
+                if debug_on:
+                    logger.debug("  Classified as %s: lines %s-%s", type.name, start_line.id, end_line_id)
                 cond = Conditional(type = type,
                     start_id = start_line.id,
                     end_id = end_line_id,
@@ -315,8 +375,9 @@ class ConditionalsMap:
             # if it is we have a standard blockwise conditional
             breaking_boundary = False
             if last_line_top_state.type == StateType.PARAGRAPH and next_line:
-                if (next_line_state_stack.top().type == StateType.PARAGRAPH and
-                    next_line_state_stack.top().subtype != StateSubtype.FIRST_LINE):
+                next_line_top_state = next_line_state_stack.top()
+                if (next_line_top_state.type == StateType.PARAGRAPH and
+                    next_line_top_state.subtype != StateSubtype.FIRST_LINE):
                     breaking_boundary = True
             elif last_line_top_state.type == StateType.LIST_ITEM and next_line:
                 # work out if the next line is in the same list item
@@ -331,7 +392,8 @@ class ConditionalsMap:
 
             if not breaking_boundary:
                 # normal block style conditional
-                logger.debug(f"  Classified as BLOCKS: lines {start_line.id}-{end_line_id}")
+                if debug_on:
+                    logger.debug("  Classified as BLOCKS: lines %s-%s", start_line.id, end_line_id)
                 cond = Conditional(type = ConditionalType.BLOCKS,
                                     start_id = start_line.id,
                                     end_id = end_line_id,
@@ -347,7 +409,8 @@ class ConditionalsMap:
             if first_line_top_state.type == StateType.PARAGRAPH:
                 if last_line_top_state.type == StateType.PARAGRAPH:
                     if last_line_top_state.get("start_line") == first_line_top_state.get("start_line"):
-                        logger.debug(f"  Classified as PARTIAL (paragraph start): lines {start_line.id}-{end_line_id}")
+                        if debug_on:
+                            logger.debug("  Classified as PARTIAL (paragraph start): lines %s-%s", start_line.id, end_line_id)
                         cond = Conditional(type = ConditionalType.PARTIAL,
                             start_id = start_line.id,
                             end_id = end_line_id,
@@ -358,9 +421,10 @@ class ConditionalsMap:
                         continue       
 
             # if we reach this place, the conditional is not supported
-            logger.debug(f"  Skipping (breaks boundary, includes multiple items)")
+            if debug_on:
+                logger.debug("  Skipping (breaks boundary, includes multiple items)")
             logger.warning(f"Conditional ends mid-paragraph/list item and includes several items, line {start_line.id}  - unsupported")
-            end_ids_unsupported.append(end_line_id)
+            end_ids_unsupported.add(end_line_id)
             idx+=1
             continue 
 
@@ -1,6 +1,5 @@
 from enum import Enum, auto
 from typing import Dict, Any, List, Optional, Set
-import copy
 
 
 class StateType(Enum):
@@ -87,9 +86,34 @@ VALID_SUBTYPES: Dict[StateType, Set[StateSubtype]] = {
 }
 
 
+# Interned parameterless states, see State.make()
+_INTERNED_STATES: Dict[tuple, 'State'] = {}
+
+
+# state types that bound the list/paragraph context: the root and delimited blocks
+BOUNDARY_TYPES = frozenset({StateType.ROOT, StateType.DELIMITED_BLOCK})
+# state types of lines that carry no text: they are skipped, together with blank lines,
+# when looking for the text a conditional applies to
+NONTEXT_TYPES = frozenset({StateType.CONDITIONAL, StateType.LINE_COMMENT, StateType.ATTRIBUTE_DEFINITION})
+
+
 class State:
     """Represents a single state in the state stack"""
 
+    __slots__ = ('type', 'subtype', 'parameters')
+
+    @classmethod
+    def make(cls, type: StateType, subtype: StateSubtype, parameters: Dict[str, Any] = None) -> 'State':
+        """Create a state; a state without parameters is interned, so all equal ones are the same object
+           IMPORTANT: interned states are shared - never modify a state obtained from make() without parameters"""
+        if parameters:
+            return cls(type, subtype, parameters)
+        key = (type, subtype)
+        state = _INTERNED_STATES.get(key)
+        if state is None:
+            state = _INTERNED_STATES[key] = cls(type, subtype)
+        return state
+
     def __init__(self, type: StateType, subtype: StateSubtype, parameters: Dict[str, Any] = None):
         # Validate type/subtype combination
         if subtype not in VALID_SUBTYPES[type]:
@@ -107,6 +131,8 @@ class State:
         return f"State({self.type.name}, {self.subtype.name}, {self.parameters})"
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if not isinstance(other, State):
             return False
         return (self.type == other.type and
@@ -129,26 +155,37 @@ class State:
     # Helper method for creating an independent copy
     def duplicate(self) -> 'State':
         """Create an independent deep copy of this State"""
-        return State(
-            type=self.type,
-            subtype=self.subtype,
-            parameters=copy.deepcopy(self.parameters)
-        )
+        return self._clone()
+
+    def _clone(self) -> 'State':
+        """Fast copy without validation - the source state is already valid.
+           Parameter values are plain strings and integers, so a copy of the dict
+           is as independent as a deep copy"""
+        state = State.__new__(State)
+        state.type = self.type
+        state.subtype = self.subtype
+        state.parameters = dict(self.parameters)
+        return state
         
 
 
 class StateStack:
     """Stack of State objects representing the parsing context"""
 
+    __slots__ = ('_stack', '_types')
+
     def __init__(self):
         self._stack: List[State] = []
+        # parallel to _stack: the type value of every state, so type searches run in C
+        # (the type of a state never changes once it is created)
+        self._types = bytearray()
 
     def top_by_type(self, type: StateType) -> Optional[State]:
         """Find the topmost state of the specified type"""
-        for state in reversed(self._stack):
-            if state.type == type:
-                return state
-        return None
+        try:
+            return self._stack[self._types.rindex(type.value)]
+        except ValueError:
+            return None
 
     def top_by_type_and_subtype(self, type: StateType, subtype: StateSubtype) -> Optional[State]:
         """Find the topmost state matching both type and subtype"""
@@ -170,9 +207,9 @@ class StateStack:
             raise KeyError(f"State not in stack. \nstate: {state}\nstack: {self._stack}")
         popped = None
         while popped != state:
-            popped = self._stack.pop()
+            popped = self.pop()
         if not inclusive:
-            self._stack.append(state)
+            self.push(state)
 
     def pop_until_delimited_block(self, inclusive: bool = True) -> str:
         """Pop and discard all items until the top delimited block;
@@ -186,43 +223,93 @@ class StateStack:
 
     def is_in_list_item(self) -> bool:
         """Check if currently in a list item"""
-        return self.top_by_type(StateType.LIST_ITEM) is not None
+        return StateType.LIST_ITEM.value in self._types
 
     def is_in_verbatim_block(self) -> bool:
-        """Check if currently in a verbatim delimited block"""
-        for state in reversed(self._stack):
-            if state.type == StateType.DELIMITED_BLOCK and state.subtype == StateSubtype.VERBATIM:
-                return True
-        return False
+        """Check if currently in a verbatim delimited block
+           Nothing nests inside a verbatim block, so it can only be the topmost delimited block"""
+        delim_state = self.top_by_type(StateType.DELIMITED_BLOCK)
+        return delim_state is not None and delim_state.subtype == StateSubtype.VERBATIM
 
     def is_in_paragraph(self) -> bool:
         """Check if currently in a paragraph"""
-        return self.top_by_type(StateType.PARAGRAPH) is not None
+        return StateType.PARAGRAPH.value in self._types
 
     def push(self, state: State):
         """Add a state to the top of the stack"""
         self._stack.append(state)
+        self._types.append(state.type.value)
+
+    # NOTE: copies of a stack share the State objects; the stacks are independent, but
+    # a state taken from a stack must be duplicated before it is changed
 
     def copy(self, other: 'StateStack'):
         """Copy another StateStack into this one (must be empty)"""
         if self._stack:
             raise ValueError("Attempted to copy into a non-empty state stack")
-        self._stack = copy.deepcopy(other._stack)
+        self._stack = other._stack[:]
+        self._types = bytearray(other._types)
 
     def duplicate(self) -> 'StateStack':
-        """Return a deep copy of this StateStack as a new object"""
-        new_stack = StateStack()
-        new_stack._stack = copy.deepcopy(self._stack)
+        """Return a copy of this StateStack as a new object (sharing the State objects)"""
+        new_stack = StateStack.__new__(StateStack)
+        new_stack._stack = self._stack[:]
+        new_stack._types = bytearray(self._types)
+        return new_stack
+
+    def with_top(self, state: State) -> 'StateStack':
+        """Return a copy of this StateStack with the given state pushed on top"""
+        new_stack = StateStack.__new__(StateStack)
+        new_stack._stack = self._stack + [state]
+        new_stack._types = self._types + bytes((state.type.value,))
+        return new_stack
+
+    def with_replaced_top(self, state: State) -> 'StateStack':
+        """Return a copy of this StateStack with the top state replaced by the given one"""
+        if not self._stack:
+            raise IndexError("with_replaced_top called on empty state stack")
+        new_stack = StateStack.__new__(StateStack)
+        new_stack._stack = self._stack[:-1]
+        new_stack._stack.append(state)
+        new_stack._types = self._types[:-1]
+        new_stack._types.append(state.type.value)
         return new_stack
 
+    def _delim_or_root_index(self) -> int:
+        """Return the index of the topmost root or delimited block state"""
+        for i in range(len(self._stack) - 1, -1, -1):
+            if self._stack[i].type in BOUNDARY_TYPES:
+                return i
+        raise IndexError("no root or delimited block in state stack")
+
     def until_delim_or_root(self):
         """Return a copy with all all items until root or a delimited block discarded; 
            the root/delimited block itself remains"""
-        result = self.duplicate()
-        while not result.top().type in [StateType.ROOT, StateType.DELIMITED_BLOCK]:
-            result.pop()
+        end = self._delim_or_root_index() + 1
+        result = StateStack.__new__(StateStack)
+        result._stack = self._stack[:end]
+        result._types = self._types[:end]
         return result
 
+    def iter_top_down(self):
+        """Iterate over the states from the top of the stack down, without copying the stack"""
+        return reversed(self._stack)
+
+    def slice_below(self, depth: int) -> 'StateStack':
+        """Return a copy holding only the states below the one at `depth` (0 is the top)"""
+        end = len(self._stack) - 1 - depth
+        result = StateStack.__new__(StateStack)
+        result._stack = self._stack[:end]
+        result._types = self._types[:end]
+        return result
+
+    def _delim_or_root_prefix(self) -> tuple:
+        """Return the states up to and including the topmost root or delimited block
+           as a tuple of (type, subtype, parameters) triples; comparing two such tuples
+           is the same as comparing the results of until_delim_or_root, without copying"""
+        return tuple((state.type, state.subtype, frozenset(state.parameters.items()))
+                     for state in self._stack[:self._delim_or_root_index() + 1])
+
     def top(self) -> State:
         """Get the top state without removing it"""
         if self._stack:
@@ -233,6 +320,7 @@ class StateStack:
     def pop(self) -> State:
         """Remove and return the top state"""
         if self._stack:
+            self._types.pop()
             return self._stack.pop()
         else:
             raise IndexError("pop called on empty state stack")
@@ -274,24 +362,68 @@ class StateStack:
 class Line:
     """The main class abstracting an entire line"""
 
-    def __init__(self, id: int, content: str):
+    __slots__ = ('_id', '_content', '_is_blank', 'state_stack', '_state_stack_after', '_delim_prefix_cache',
+                 'prev', 'next')
+
+    def __init__(self, id: int, content: str, state_stack: Optional[StateStack] = None):
         self._id = id  # the immutable line ID; all other values are mutable
         self.content = content  # the text in the line
-        self.state_stack = StateStack()
-        self.state_stack_after = StateStack()
+        # NOTE: the parser shares one StateStack object between lines with the same state
+        self.state_stack = state_stack if state_stack is not None else StateStack()
+        self._state_stack_after = None  # created on first access, most lines never need it
+        self._delim_prefix_cache = None  # memoized result of delim_or_root_prefix()
+        # the neighbouring lines in the document, maintained by Parsed; None at either end or outside a document
+        self.prev: Optional['Line'] = None
+        self.next: Optional['Line'] = None
 
     @property
     def id(self) -> int:
         """Immutable line identifier"""
         return self._id
 
+    @property
+    def content(self) -> str:
+        """The text in the line"""
+        return self._content
+
+    @content.setter
+    def content(self, value: str):
+        self._content = value
+        self._is_blank = None  # recomputed on next access to is_blank
+
+    @property
+    def state_stack_after(self) -> StateStack:
+        """State stack after the line"""
+        if self._state_stack_after is None:
+            self._state_stack_after = StateStack()
+        return self._state_stack_after
+
+    @state_stack_after.setter
+    def state_stack_after(self, value: StateStack):
+        self._state_stack_after = value
+
+    @property
+    def is_blank(self) -> bool:
+        """True if the line is empty or whitespace only; cached until the content changes"""
+        if self._is_blank is None:
+            # isspace() answers the same question as strip() without building a new string
+            self._is_blank = not self._content or self._content.isspace()
+        return self._is_blank
+
+    def delim_or_root_prefix(self) -> tuple:
+        """Memoized state_stack._delim_or_root_prefix()
+           IMPORTANT: only valid once parsing is finished and the state stack no longer changes"""
+        if self._delim_prefix_cache is None:
+            self._delim_prefix_cache = self.state_stack._delim_or_root_prefix()
+        return self._delim_prefix_cache
+
     def pretty(self) -> str:
         """Return a pretty-printed representation of this line"""
         result = []
         result.append(f"\nLine {self.id}: {repr(self.content)}")
         result.append("  State stack:")
         result.append(self.state_stack.pretty(indent=4))
-        if len(self.state_stack_after) > 0:
+        if self._state_stack_after:
             result.append("  State stack after:")
             result.append(self.state_stack_after.pretty(indent=4))
         return "\n".join(result)
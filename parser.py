@@ -1,22 +1,34 @@
-from line_types import Line, State, StateType, StateSubtype, StateStack
+from line_types import Line, State, StateType, StateSubtype, StateStack, BOUNDARY_TYPES
 from typing import Optional, List
+from sys import intern
 import logging
 import regexes
 
 logger = logging.getLogger(__name__)
 
+# first character -> bound match method of the fused line classification regex, used for every line in _parse_line
+_classify_by_first_char = regexes.LINE_CLASSIFY_BY_FIRST_CHAR
+_DELIMITER_FIRST_CHARS = regexes.DELIMITER_FIRST_CHARS
+# inside a verbatim block only conditionals and the closing delimiter are recognized,
+# so only lines that can start a conditional need the regex there
+_classify_verbatim_by_first_char = {char: _classify_by_first_char[char] for char in "ie"}
+# shared empty stack every new line starts with in _parse_line, so that no stack is created per line;
+# it is never modified, and a line still holding it after parsing is a logic error
+_UNSET_STATE_STACK = StateStack()
+
 
 class Parsed:
     """The full parsed text of an Asciidoc module"""
 
+    __slots__ = ('_next_line_id', 'last_original_id', '_updating_last_original_id',
+                 '_head', '_tail', '_count', '_by_id', '_lines', '_pos', '_open_conditionals')
+
     # Generation of unique IDs for lines. When processing original text, the line id should
     # be the line number. Then there is a large base for ids of additional lines.
     # IMPORTANT: there is NO guarantee of continuous or sequential line IDs in total
     # however the original lines can be acesed by original IDs - but handle skips gracefully (intercept KeyError)
-    _next_line_id = 1 # for reference - this is also repeated in __init__
+    # The line ID counter and last_original_id are initialized in __init__
     ADDED_LINE_START = 10000
-    last_original_id = -1
-    _updating_last_original_id = True
 
     def _new_line_id(self) -> int:
         """Get next line ID and increment counter"""
@@ -31,6 +43,50 @@ class Parsed:
         else:
             self._next_line_id = self.ADDED_LINE_START
 
+    # The lines of the document form a doubly linked list (Line.prev/Line.next, kept by the methods
+    # below), so inserting and removing a line is O(1); _by_id finds a line by its ID.
+    # The list of lines and the index of every line in it are built on demand and
+    # dropped whenever a line is inserted or removed
+
+    @property
+    def lines(self) -> List[Line]:
+        """All lines of the document, in order.
+           IMPORTANT: do not modify this list, use the methods of Parsed to change the document"""
+        if self._lines is None:
+            lines = []
+            line = self._head
+            while line is not None:
+                lines.append(line)
+                line = line.next
+            self._lines = lines
+        return self._lines
+
+    def _changed(self):
+        """Drop the list and index of lines after an insertion or removal"""
+        self._lines = None
+        self._pos = None
+
+    def _check_in_document(self, line: Line):
+        """Raise ValueError if the Line object is not in the document"""
+        if self._by_id.get(line.id) is not line:
+            raise ValueError(f"Line {line.id} not found in document")
+
+    def _link_last(self, line: Line):
+        """Add a line at the end of the document; the list and index of lines stay valid"""
+        line.prev = self._tail
+        line.next = None
+        if self._tail is None:
+            self._head = line
+        else:
+            self._tail.next = line
+        self._tail = line
+        self._by_id[line.id] = line
+        if self._lines is not None:
+            self._lines.append(line)
+        if self._pos is not None:
+            self._pos[line.id] = self._count
+        self._count += 1
+
     # direct list-like access to lines
 
     def __getitem__(self, index):
@@ -39,15 +95,35 @@ class Parsed:
 
     def __len__(self):
           """Allow len(parsed) to work"""
-          return len(self.lines)
+          return self._count
     
-    def __setitem__(self, index, value):
+    def __setitem__(self, index: int, value: Line):
         """Allow parsed[5] = new_line"""
-        self.lines[index] = value
+        old_line = self.lines[index]
+        # splice the new line into the place of the old one; the number of lines does not change.
+        # The old ID is dropped before the new one is added, as both can be the same
+        value.prev = old_line.prev
+        value.next = old_line.next
+        if old_line.prev is None:
+            self._head = value
+        else:
+            old_line.prev.next = value
+        if old_line.next is None:
+            self._tail = value
+        else:
+            old_line.next.prev = value
+        old_line.prev = old_line.next = None
+        del self._by_id[old_line.id]
+        self._by_id[value.id] = value
+        self._changed()
 
     def __delitem__(self, index):
         """Allow del parsed[5]"""
-        del self.lines[index]
+        lines = self.lines[index]
+        if isinstance(lines, Line):
+            lines = [lines]
+        for line in lines:
+            self.remove(line)
 
     def __iter__(self):
         """Make iteration explicit"""
@@ -55,23 +131,44 @@ class Parsed:
     
     # work with lines in the list
 
-    def create_line(self, content: str) -> Line:
-        return Line(id=self._new_line_id(), content=content)
+    def create_line(self, content: str, state_stack: Optional[StateStack] = None) -> Line:
+        return Line(id=self._new_line_id(), content=content, state_stack=state_stack)
  
 
     def index(self, line: Line) -> int:
         """Find the index of a Line object. Raises ValueError if not found."""
-        return self.lines.index(line)
+        self._check_in_document(line)
+        if self._pos is None:
+            self._pos = {line.id: i for i, line in enumerate(self.lines)}
+        return self._pos[line.id]
 
     def insert_before(self, target_line: Line, new_line: Line):
         """Insert a new line before the target line"""
-        index = self.lines.index(target_line)
-        self.lines.insert(index, new_line)
+        self._check_in_document(target_line)
+        new_line.prev = target_line.prev
+        new_line.next = target_line
+        if target_line.prev is None:
+            self._head = new_line
+        else:
+            target_line.prev.next = new_line
+        target_line.prev = new_line
+        self._by_id[new_line.id] = new_line
+        self._count += 1
+        self._changed()
 
     def insert_after(self, target_line: Line, new_line: Line):
         """Insert a new line after the target line"""
-        index = self.lines.index(target_line)
-        self.lines.insert(index + 1, new_line)
+        self._check_in_document(target_line)
+        new_line.prev = target_line
+        new_line.next = target_line.next
+        if target_line.next is None:
+            self._tail = new_line
+        else:
+            target_line.next.prev = new_line
+        target_line.next = new_line
+        self._by_id[new_line.id] = new_line
+        self._count += 1
+        self._changed()
 
     def create_line_before(self, target_line: Line, content: str) -> Line:
         """Create a new line and insert it before the target line. Returns the created line."""
@@ -87,44 +184,46 @@ class Parsed:
 
     def remove(self, line: Line):
         """Remove a line from the document"""
-        self.lines.remove(line)
+        self._check_in_document(line)
+        if line.prev is None:
+            self._head = line.next
+        else:
+            line.prev.next = line.next
+        if line.next is None:
+            self._tail = line.prev
+        else:
+            line.next.prev = line.prev
+        line.prev = line.next = None
+        del self._by_id[line.id]
+        self._count -= 1
+        self._changed()
 
 
     def line_by_id(self, line_id: int) -> Line:
         """Find a Line object by its id. Raises KeyError if not found."""
-        for line in self.lines:
-            if line.id == line_id:
-                return line
-        raise KeyError(f"No line with id {line_id} found in document")
+        try:
+            return self._by_id[line_id]
+        except KeyError:
+            raise KeyError(f"No line with id {line_id} found in document")
 
     def remove_by_id(self, line_id: int):
         """Remove a line from the document by line ID"""
-        self.lines.remove(self.line_by_id(line_id))
+        self.remove(self.line_by_id(line_id))
 
 
     def previous_line(self, line: Line) -> Optional[Line]:
         """Get the previous line in the document. Returns None if this is the first line.
            Raises KeyError if the line is not in the document."""
-        try:
-            index = self.lines.index(line)
-        except ValueError:
+        if self._by_id.get(line.id) is not line:
             raise KeyError(f"Line {line.id} not found in document")
-
-        if index == 0:
-            return None
-        return self.lines[index - 1]
+        return line.prev
 
     def next_line(self, line: Line) -> Optional[Line]:
         """Get the next line in the document. Returns None if this is the last line.
            Raises KeyError if the line is not in the document."""
-        try:
-            index = self.lines.index(line)
-        except ValueError:
+        if self._by_id.get(line.id) is not line:
             raise KeyError(f"Line {line.id} not found in document")
-
-        if index == len(self.lines) - 1:
-            return None
-        return self.lines[index + 1]
+        return line.next
 
     def pretty(self) -> str:
         """Return a readable representation of the parsed document for debugging"""
@@ -144,43 +243,57 @@ class Parsed:
         """parse a single line, creating the state stack for it.
            Uses the state stack created by parsing the previous line
            At the first line of the Asciidoc text, the state starts with a blank stack
-           NOTE: conditional lines are mostly-ignored at this stage"""
+           NOTE: conditional lines are mostly-ignored at this stage
+           IMPORTANT: copied state stacks share their State objects, so a state taken
+           from a stack must be duplicated before it is changed.
+           A line whose state is the same as the state passed to the next line shares the
+           StateStack object with it, so neither may be changed once this method returns"""
         # Check for mistaken passing of states that are not intended to be passed to the next line
         if (top_starting_state := starting_state_stack.top()):
             if (top_starting_state.type in [StateType.CONDITIONAL, StateType.BLOCK_PREFIX, 
                                            StateType.SECTION_HEADER] or
                top_starting_state.subtype == StateSubtype.JOINER):
                  raise ValueError(f"Invalid top state passed to parse_line: {top_starting_state}")
+        # starting_state_stack itself is never changed here, so its top can be read once
+        top_type = top_starting_state.type
+        top_subtype = top_starting_state.subtype
                   
         # create the Line object and add it to the lines list
         clean_text = content.replace("\n","")
-        line = self.create_line(clean_text)
-        self.lines.append(line)
+        # every branch below sets the state stack of the line
+        line = self.create_line(clean_text, _UNSET_STATE_STACK)
+        self._link_last(line)
         if self._updating_last_original_id:
             self.last_original_id = line.id
 
+        # classify the line with a single match, dispatched on the first character;
+        # kind is the name of the pattern that matched, if any.
+        # The operators, delimiters and list markers taken from the match are interned, as they
+        # come from a tiny vocabulary and are stored in state parameters across the document
+        # the first character ("" for an empty line) is taken once, for the dispatch and the checks below
+        first_char = clean_text[:1]
+        if top_subtype == StateSubtype.VERBATIM:
+            classify_match = _classify_verbatim_by_first_char.get(first_char)
+        else:
+            classify_match = _classify_by_first_char.get(first_char)
+        classified = classify_match(clean_text) if classify_match else None
+        kind = classified.lastgroup if classified else None
+
         # first check if this is a conditional
-        if (conditional_match := regexes.CONDITIONAL.match(content)):
-            operator = conditional_match.group(1)  # ifdef, ifndef, endif, ifeval
-            expression_before = conditional_match.group(2)  # before []
-            expression_inside = conditional_match.group(3)  # inside []
+        if kind == "conditional":
+            operator = intern(classified.group("cond_directive"))  # ifdef, ifndef, endif, ifeval
+            expression_before = classified.group("cond_before")  # before []
+            expression_inside = classified.group("cond_inside")  # inside []
 
             # Determine subtype and params
             params = {}
             if operator == "endif":
                 subtype = StateSubtype.END
-                # Walk backwards to find matching START
-                logger.debug("Walking back...")
-                for i in range(len(self.lines) - 2, -1, -1):
-                    prev_line = self.lines[i]
-                    logger.debug(f"Checking line: {prev_line.content}")
-                    if (prev_line.state_stack.top().type == StateType.CONDITIONAL and
-                        prev_line.state_stack.top().subtype == StateSubtype.START and
-                        prev_line.state_stack.top().get("end_line") == -1):
-                        # Found the matching start
-                        prev_line.state_stack.top()["end_line"] = line.id
-                        params["start_line"] = prev_line.id
-                        break
+                # The matching START is the most recent one not yet ended
+                if self._open_conditionals:
+                    prev_line = self._open_conditionals.pop()
+                    prev_line.state_stack.top()["end_line"] = line.id
+                    params["start_line"] = prev_line.id
                 else:
                     # No matching start found
                     logger.warning(f"endif without matching ifdef/ifndef/ifeval on line {line.id}")
@@ -202,18 +315,20 @@ class Parsed:
                     "end_line": -1
                 }
 
-            line.state_stack.copy(starting_state_stack)
-            line.state_stack.push(State(StateType.CONDITIONAL, subtype, params))
+            line.state_stack = starting_state_stack.with_top(State(StateType.CONDITIONAL, subtype, params))
+            if subtype == StateSubtype.START:
+                self._open_conditionals.append(line)
             return starting_state_stack
 
 
         # check for closing of the top delimited block, if available
-        if (delimiter := starting_state_stack.top_delimiter()):
+        # (only a line that starts like a delimiter can close a block, so other lines skip the stack search)
+        if first_char in _DELIMITER_FIRST_CHARS and (delimiter := starting_state_stack.top_delimiter()):
             if clean_text == delimiter:
                 # The state of the line is the end delimiter in that delimited block
-                line.state_stack.copy(starting_state_stack)
+                line.state_stack = starting_state_stack.duplicate()
                 line.state_stack.pop_until_delimited_block(inclusive = False)
-                delim_state = line.state_stack.pop()
+                delim_state = line.state_stack.pop().duplicate()
                 # set the block_end_line paraneter on the start line state
                 block_start_line = self.line_by_id(delim_state.get("block_start_line"))
                 block_start_line.state_stack.top().parameters["block_end_line"] = line.id
@@ -224,26 +339,25 @@ class Parsed:
                 return result_state_stack
 
         # If we were verbatim: as we already checked for a closing delimiter, we continue the state and return
-        if starting_state_stack.top().subtype == StateSubtype.VERBATIM:
-            line.state_stack.copy(starting_state_stack)
+        if top_subtype == StateSubtype.VERBATIM:
+            line.state_stack = starting_state_stack
             return starting_state_stack
         
         # process a line comment
-        if clean_text.startswith("//") and (len(clean_text)<=4 or
-                                            clean_text[2:4]!="//"):
-            line.state_stack.copy(starting_state_stack)
-            line.state_stack.push(State(StateType.LINE_COMMENT, StateSubtype.NORMAL))
+        if first_char == "/" and clean_text.startswith("//") and (len(clean_text)<=4 or
+                                                                  clean_text[2:4]!="//"):
+            line.state_stack = starting_state_stack.with_top(State.make(StateType.LINE_COMMENT, StateSubtype.NORMAL))
             return starting_state_stack
         
         # process an attribute definition
-        if regexes.ATTRIBUTE_DEFINITION.match(clean_text):
-            line.state_stack.copy(starting_state_stack)
-            line.state_stack.push(State(StateType.ATTRIBUTE_DEFINITION, StateSubtype.NORMAL))
+        if kind == "attribute_definition":
+            line.state_stack = starting_state_stack.with_top(State.make(StateType.ATTRIBUTE_DEFINITION, StateSubtype.NORMAL))
             return starting_state_stack
 
 
         # Process a delimiter starting a new block
-        if (delimiter := regexes.is_delimiter(clean_text)):
+        if kind == "delimiter":
+            delimiter = intern(classified.group("delimiter_text"))
 
             # determine the first line of the new block - this line or pull in any immediately preceding block prefixes
             first_line = line.id
@@ -258,60 +372,59 @@ class Parsed:
 
             result_state_stack = starting_state_stack.duplicate()
             # if we are in a paragraph, terminate the paragraph, reverting to the state under it
-            if result_state_stack.top().type == StateType.PARAGRAPH:
+            if top_type == StateType.PARAGRAPH:
                 result_state_stack.pop()
             # if we are in a list item right after a joiner, this is a joined block
             # in a list in any other place: terminate the list item and any list items under it
-            if result_state_stack.top().type == StateType.LIST_ITEM:
-                if result_state_stack.top().subtype == StateSubtype.JOINED_FIRST_LINE:
-                    list_state = result_state_stack.pop()
+            result_top = result_state_stack.top()
+            if result_top.type == StateType.LIST_ITEM:
+                if result_top.subtype == StateSubtype.JOINED_FIRST_LINE:
+                    list_state = result_top.duplicate()
                     list_state.subtype = StateSubtype.JOINED_DELIMITED_BLOCK
-                    result_state_stack.push(list_state)
+                    result_state_stack = result_state_stack.with_replaced_top(list_state)
                 else:
                     while result_state_stack.top().type == StateType.LIST_ITEM:
                         result_state_stack.pop()
                         # Note - this is expected to reach a root or delimited block
                         # if this reaches an empty state it is an error and the exceptiom is correct
 
-            line.state_stack.copy(result_state_stack)
-            line.state_stack.push(State(StateType.DELIMITED_BLOCK, StateSubtype.START, block_param))
+            # the start line state gets its own parameters, as block_end_line is set on it later
+            line.state_stack = result_state_stack.with_top(State(StateType.DELIMITED_BLOCK, StateSubtype.START, dict(block_param)))
             subtype = StateSubtype.VERBATIM if regexes.is_delimiter_verbatim(delimiter) else StateSubtype.NORMAL
             result_state_stack.push(State(StateType.DELIMITED_BLOCK, subtype, block_param))
             return result_state_stack
 
         # Process a blank line
-        if clean_text == "":
-            if starting_state_stack.top().type == StateType.PARAGRAPH:
+        if not first_char:
+            if top_type == StateType.PARAGRAPH:
                 # a blank line terminates a paragraph, reinstating the state immediately underlying it
-                result_state_stack=starting_state_stack.duplicate()
-                result_state_stack.pop()
-                line.state_stack.copy(result_state_stack)
+                result_state_stack = starting_state_stack.slice_below(0)
+                line.state_stack = result_state_stack
                 return result_state_stack
-            if starting_state_stack.top().type == StateType.LIST_ITEM:
+            if top_type == StateType.LIST_ITEM:
                 # blank line terminates a list item, but, in itself, not yet the list
                 # except if the current state is "right after a joiner" it can be ancestor list continuation
-                new_state_stack = starting_state_stack.duplicate()
-                list_state = new_state_stack.pop()
-                if list_state.subtype == StateSubtype.JOINED_FIRST_LINE:
-                    if new_state_stack.top() and new_state_stack.top().type == StateType.LIST_ITEM:
+                if top_subtype == StateSubtype.JOINED_FIRST_LINE:
+                    new_state_stack = starting_state_stack.slice_below(0)
+                    if new_state_stack and new_state_stack.top().type == StateType.LIST_ITEM:
                         # ancestor list continuation, see documentation:
                         # https://docs.asciidoctor.org/asciidoc/latest/lists/continuation/#ancestor-list-continuation
-                        ancestor_list_state = new_state_stack.pop()
+                        ancestor_list_state = new_state_stack.pop().duplicate()
                         current_line_list_state = ancestor_list_state.duplicate()
                         current_line_list_state.subtype = StateSubtype.JOINER
-                        line.state_stack.copy(new_state_stack)
-                        line.state_stack.push(current_line_list_state)
+                        line.state_stack = new_state_stack.with_top(current_line_list_state)
                         ancestor_list_state.subtype = StateSubtype.JOINED_FIRST_LINE
                         new_state_stack.push(ancestor_list_state)
                         return new_state_stack
                         
+                list_state = top_starting_state.duplicate()
                 list_state.subtype = StateSubtype.TERMINATED
-                new_state_stack.push(list_state)
-                line.state_stack.copy(new_state_stack)
+                new_state_stack = starting_state_stack.with_replaced_top(list_state)
+                line.state_stack = new_state_stack
                 return new_state_stack
             # At this point, we are processing a blank line and the state type is ROOT or DELIMITED_BLOCK
             # In this case the state does not change
-            line.state_stack.copy(starting_state_stack)
+            line.state_stack = starting_state_stack
             return starting_state_stack
 
         # Continuation marker (+) - only valid in list item context
@@ -319,80 +432,72 @@ class Parsed:
         # However if there was a delimited block in the list item, a + is valid after it
         # That is what the JOINED_DELIMITED_BLOCK state is for
         if clean_text == "+":
-            if (starting_state_stack.top().type == StateType.LIST_ITEM and 
-                starting_state_stack.top().subtype != StateSubtype.TERMINATED):
+            if (top_type == StateType.LIST_ITEM and 
+                top_subtype != StateSubtype.TERMINATED):
                 # Warn if we're already in a joined state
-                if starting_state_stack.top().subtype == StateSubtype.JOINED_FIRST_LINE:
+                if top_subtype == StateSubtype.JOINED_FIRST_LINE:
                     logger.warning(f"+ continuation marker immediately after another + on line {line.id}")
 
                 # The + line gets marked with JOINER subtype
-                result_state_stack = starting_state_stack.duplicate()
-                list_item_state = result_state_stack.pop()
-
-                # Mark this line as JOINER
-                line_list_item_state = list_item_state.duplicate()
+                line_list_item_state = top_starting_state.duplicate()
                 line_list_item_state.subtype = StateSubtype.JOINER
-                line.state_stack.copy(result_state_stack)
-                line.state_stack.push(line_list_item_state)
+                line.state_stack = starting_state_stack.with_replaced_top(line_list_item_state)
 
                 # For the next line, transition to JOINED_FIRST_LINE
+                list_item_state = top_starting_state.duplicate()
                 list_item_state.subtype = StateSubtype.JOINED_FIRST_LINE
-                result_state_stack.push(list_item_state)
-                return result_state_stack
+                return starting_state_stack.with_replaced_top(list_item_state)
             # If not in list item context, fall through to treat as regular content
             else:
                 logger.warning(f"single + is not a valid joiner, line {line.id}")
 
         # Block attribute line
-        if clean_text.startswith("[") and clean_text.endswith("]"):
-            new_state_stack = starting_state_stack.duplicate()
+        if first_char == "[" and clean_text.endswith("]"):
+            new_state_stack = starting_state_stack
 
-            if new_state_stack.top().type == StateType.PARAGRAPH:
+            if top_type == StateType.PARAGRAPH:
                 # A paragraph is ended, reinstating the state immediately underlying it
-                new_state_stack.pop()
-            elif new_state_stack.top().type == StateType.LIST_ITEM:
+                new_state_stack = starting_state_stack.slice_below(0)
+            elif top_type == StateType.LIST_ITEM:
                 # A list item is continued, but if inside a joined paragraph, a new joined paragraph begins
                 # note that an existing JOINED_FIRST_LINE state is continued - handled by the default case below
                 # TODO: investigate what happens right after a joined delim block
-                if new_state_stack.top().subtype == StateSubtype.JOINED_NORMAL:
-                    list_item_state = new_state_stack.pop()
+                if top_subtype == StateSubtype.JOINED_NORMAL:
+                    list_item_state = top_starting_state.duplicate()
                     list_item_state.subtype = StateSubtype.JOINED_FIRST_LINE
-                    new_state_stack.push(list_item_state) 
+                    new_state_stack = starting_state_stack.with_replaced_top(list_item_state)
                     # this does mean both the block prefix line and the line after it get JOINED_FIRST_LINE
                     # at this moment I see no cleaner way to handle this 
                     # note the top state for the block prefix is BLOCK_PREFIX
-            line.state_stack.copy(new_state_stack)
-            line.state_stack.push(State(StateType.BLOCK_PREFIX,StateSubtype.BLOCK_ATTRIBUTES))
+            line.state_stack = new_state_stack.with_top(State.make(StateType.BLOCK_PREFIX,StateSubtype.BLOCK_ATTRIBUTES))
             return new_state_stack
         
 
         # List item start - note these do NOT work in-paragraph
-        if ((list_match := regexes.LIST_ITEM.match(clean_text)) and 
-            starting_state_stack.top().type != StateType.PARAGRAPH):
-            list_marker = list_match.group(1)  # Extract the actual marker string ("*", "**", ".", etc.)
+        if kind == "list_item" and top_type != StateType.PARAGRAPH:
+            list_marker = intern(classified.group("list_marker"))  # Extract the actual marker string ("*", "**", ".", etc.)
             existing_list_state_stack_base = None
             existing_list_state = None
-            if starting_state_stack.top().type == StateType.LIST_ITEM:
+            if top_type == StateType.LIST_ITEM:
                 # check if we might already be inside this type of list
                 # Importantly not just this one list but any encompassing lists - up to either root or delimiter block
 
-                analysis_state_stack = starting_state_stack.duplicate()
-                analysis_state = analysis_state_stack.pop()
-                while not (analysis_state.type in [StateType.ROOT, StateType.DELIMITED_BLOCK]):
+                for depth, analysis_state in enumerate(starting_state_stack.iter_top_down()):
+                    if analysis_state.type in BOUNDARY_TYPES:
+                        break
                     if analysis_state.type == StateType.LIST_ITEM and analysis_state.get("marker") == list_marker:
-                        existing_list_state_stack_base = analysis_state_stack
+                        existing_list_state_stack_base = starting_state_stack.slice_below(depth)
                         existing_list_state = analysis_state
                         break
-                    analysis_state = analysis_state_stack.pop()
             # at this point if an existing list is applicable the correct state for it is in
             # existing_list_state and the lower levels for it in existing_list_state_stack_base
             if existing_list_state_stack_base and existing_list_state:
+                existing_list_state = existing_list_state.duplicate()
                 existing_list_state.subtype = StateSubtype.FIRST_LINE
                 existing_list_state.parameters["item_start_line"] = line.id
                 next_line_list_state = existing_list_state.duplicate()
                 next_line_list_state.subtype = StateSubtype.NORMAL
-                line.state_stack.copy(existing_list_state_stack_base)
-                line.state_stack.push(existing_list_state)
+                line.state_stack = existing_list_state_stack_base.with_top(existing_list_state)
                 result_state_stack = existing_list_state_stack_base # just for clarity - still same object
                 result_state_stack.push(next_line_list_state)
                 return result_state_stack
@@ -405,17 +510,15 @@ class Parsed:
             next_line_list_state = new_list_state.duplicate()
             next_line_list_state.subtype = StateSubtype.NORMAL
             result_state_stack = starting_state_stack.duplicate()
-            line.state_stack.copy(result_state_stack)
-            line.state_stack.push(new_list_state)
+            line.state_stack = result_state_stack.with_top(new_list_state)
             result_state_stack.push(next_line_list_state)
             return result_state_stack
 
         # Block title line
-        if len(clean_text)>1 and clean_text.startswith(".") and not clean_text[1].isspace() and clean_text[1]!=".":
-            if starting_state_stack.top().type in [StateType.ROOT, StateType.DELIMITED_BLOCK]:
+        if first_char == "." and len(clean_text)>1 and not clean_text[1].isspace() and clean_text[1]!=".":
+            if top_type in BOUNDARY_TYPES:
                 # A block title is always a block title in root or in base delimiter block
-                line.state_stack.copy(starting_state_stack)
-                line.state_stack.push(State(StateType.BLOCK_PREFIX,StateSubtype.BLOCK_TITLE))
+                line.state_stack = starting_state_stack.with_top(State.make(StateType.BLOCK_PREFIX,StateSubtype.BLOCK_TITLE))
                 return starting_state_stack
             # In a paragraph a like that looks like a block title line is NOT a block title, so no need to process here
             # Inside a list item it works the same way, BUT in a joint list paragraph it marks a new joint paragraph
@@ -423,79 +526,74 @@ class Parsed:
             #   which is processed by keeping JOINED_FIRST_LINE for both this and next line)
             # ...and if the list item is terminated, a block title terminates the list!
             # TODO: investigate what happens right after a joined delim block
-            if starting_state_stack.top().type == StateType.LIST_ITEM:
-                if starting_state_stack.top().subtype in [StateSubtype.JOINED_FIRST_LINE, StateSubtype.JOINED_NORMAL]:
-                    new_state_stack = starting_state_stack.duplicate()
-                    line_item_state = new_state_stack.pop()
+            if top_type == StateType.LIST_ITEM:
+                if top_subtype in [StateSubtype.JOINED_FIRST_LINE, StateSubtype.JOINED_NORMAL]:
+                    line_item_state = top_starting_state.duplicate()
                     line_item_state.subtype = StateSubtype.JOINED_FIRST_LINE
-                    new_state_stack.push(line_item_state)
+                    new_state_stack = starting_state_stack.with_replaced_top(line_item_state)
                     # this does mean both the block prefix line and the line after it get JOINED_FIRST_LINE
                     # at this moment I see no cleaner way to handle this 
                     # note the top state for the block prefix is BLOCK_PREFIX
-                    line.state_stack.copy(new_state_stack)
-                    line.state_stack.push(State(StateType.BLOCK_PREFIX,StateSubtype.BLOCK_TITLE))
+                    line.state_stack = new_state_stack.with_top(State.make(StateType.BLOCK_PREFIX,StateSubtype.BLOCK_TITLE))
                     return new_state_stack
-                if starting_state_stack.top().subtype == StateSubtype.TERMINATED:
+                if top_subtype == StateSubtype.TERMINATED:
                     # Terminate the list and all list under it
                     result_state_stack = starting_state_stack.duplicate()
                     while result_state_stack.top().type == StateType.LIST_ITEM:
                         result_state_stack.pop()
-                    line.state_stack.copy(result_state_stack)
-                    line.state_stack.push(State(StateType.BLOCK_PREFIX,StateSubtype.BLOCK_TITLE))
+                    line.state_stack = result_state_stack.with_top(State.make(StateType.BLOCK_PREFIX,StateSubtype.BLOCK_TITLE))
                     return result_state_stack
 
         # Section header line - warn if not in root; mark line, pass thru state
         # Is only processed in root, delimited block, and after a terminated list item/after delim block (terminates list) 
         # can't condition header lines but this comes later
         # We use new_state_stack as the flag - if it's assigned the header line is actually a header line
-        if regexes.SECTION_HEADER.match(clean_text):
+        if kind == "section_header":
             new_state_stack = None
-            if (starting_state_stack.top().type == StateType.LIST_ITEM and
-                starting_state_stack.top().subtype in [StateSubtype.TERMINATED, StateSubtype.JOINED_DELIMITED_BLOCK] ):
+            if (top_type == StateType.LIST_ITEM and
+                top_subtype in [StateSubtype.TERMINATED, StateSubtype.JOINED_DELIMITED_BLOCK] ):
                 new_state_stack = starting_state_stack.duplicate()
                 # Terminate the list and all list under it
                 while new_state_stack.top().type == StateType.LIST_ITEM:
                     new_state_stack.pop()
-            elif starting_state_stack.top().type in [StateType.ROOT, StateType.DELIMITED_BLOCK]:
+            elif top_type in BOUNDARY_TYPES:
                 new_state_stack = starting_state_stack.duplicate()
             if new_state_stack:
                 if new_state_stack.top().type == StateType.DELIMITED_BLOCK:
                     logger.warning(f"Section title inside delimited block on line {line.id}")
-                line.state_stack.copy(new_state_stack)
-                line.state_stack.push(State(StateType.SECTION_HEADER,StateSubtype.NORMAL))
+                line.state_stack = new_state_stack.with_top(State.make(StateType.SECTION_HEADER,StateSubtype.NORMAL))
                 return new_state_stack
 
         # if we are here, this is just a normal line, not a list item start, not an empty line, etc
         # If we are in a paragraph the line continues the state
-        if starting_state_stack.top().type == StateType.PARAGRAPH:
-            line.state_stack.copy(starting_state_stack)
+        if top_type == StateType.PARAGRAPH:
+            line.state_stack = starting_state_stack
             return starting_state_stack
 
         # If in a list item:
         #    - in most subtypes continue the same state
         #    - if JOINED_FIRST_LINE was the starting state, use it, mark first line id, continue with JOINED_NORMAL
         #    - if terminated or after a joined delimited block, terminate all lists then new paragraph
-        result_state_stack = starting_state_stack.duplicate()
-        if starting_state_stack.top().type == StateType.LIST_ITEM:
-            if starting_state_stack.top().subtype in [StateSubtype.JOINED_DELIMITED_BLOCK,
+        result_state_stack = starting_state_stack
+        if top_type == StateType.LIST_ITEM:
+            if top_subtype in [StateSubtype.JOINED_DELIMITED_BLOCK,
                                                       StateSubtype.TERMINATED]:
                 # Pop all lists from new_state_stack
+                result_state_stack = starting_state_stack.duplicate()
                 while result_state_stack.top().type == StateType.LIST_ITEM:
                     result_state_stack.pop()
                 # note we do NOT return so the process continues to creating a new paragraph
-            elif (starting_state_stack.top().type == StateType.LIST_ITEM and
-                    starting_state_stack.top().subtype == StateSubtype.JOINED_FIRST_LINE):
-                    list_item_state = result_state_stack.pop()
+            elif (top_type == StateType.LIST_ITEM and
+                    top_subtype == StateSubtype.JOINED_FIRST_LINE):
+                    list_item_state = top_starting_state.duplicate()
                     list_item_state.parameters["joined_start_line"] = line.id
                     next_line_list_item_state = list_item_state.duplicate()
                     next_line_list_item_state.subtype = StateSubtype.JOINED_NORMAL
-                    line.state_stack.copy(result_state_stack)
-                    line.state_stack.push(list_item_state)
-                    result_state_stack.push(next_line_list_item_state)
-                    return result_state_stack
+                    line.state_stack = starting_state_stack.with_replaced_top(list_item_state)
+                    return starting_state_stack.with_replaced_top(next_line_list_item_state)
             
             else: 
-                line.state_stack.copy(starting_state_stack)
+                line.state_stack = starting_state_stack
                 return starting_state_stack
 
         # at this point we are in root or a delimited block, or we have just terminated a list
@@ -503,33 +601,51 @@ class Parsed:
         paragraph_state = State(StateType.PARAGRAPH, StateSubtype.FIRST_LINE, {"first_line": line.id})
         next_line_paragraph_state = paragraph_state.duplicate()
         next_line_paragraph_state.subtype = StateSubtype.NORMAL
-        line.state_stack.copy(result_state_stack)
-        line.state_stack.push(paragraph_state)
-        result_state_stack.push(next_line_paragraph_state)
-        return result_state_stack
+        line.state_stack = result_state_stack.with_top(paragraph_state)
+        return result_state_stack.with_top(next_line_paragraph_state)
     
+    @classmethod
+    def from_text(cls, text: str) -> 'Parsed':
+        """Parse a whole document given as one string.
+           The text is split on newlines only, like readlines() does: str.splitlines() would
+           also split on form feeds and other separators that can appear inside a line"""
+        lines = text.split("\n")
+        if lines[-1] == "":
+            lines.pop()  # the newline at the end of the last line does not start another line
+        return cls(lines)
+
     def __init__(self, lines: List[str]):
         self.last_original_id = -1
         self._updating_last_original_id = True
 
         self._next_line_id = 1
-        self.lines = []
+        self._head = None
+        self._tail = None
+        self._count = 0
+        self._by_id = {}
+        # the list and index of lines start out empty and valid, so parsing keeps them built
+        self._lines = []
+        self._pos = {}
+        # conditional START lines not yet matched by an endif, innermost last
+        self._open_conditionals = []
         running_state_stack = StateStack()
-        running_state_stack.push(State(StateType.ROOT, StateSubtype.NORMAL))
+        running_state_stack.push(State.make(StateType.ROOT, StateSubtype.NORMAL))
+        # the debug messages format whole state stacks, so they are only built when debug logging is on
+        debug_on = logger.isEnabledFor(logging.DEBUG)
         for line in lines:
-            logger.debug(f"Starting state stack: {running_state_stack.pretty()}")
-            logger.debug(f"Line: {line.rstrip()}")
+            if debug_on:
+                logger.debug("Starting state stack: %s", running_state_stack.pretty())
+                logger.debug("Line: %s", line.rstrip())
             running_state_stack = self._parse_line(line, running_state_stack)
-            logger.debug(f"Last line state stack: {self.lines[-1].state_stack.pretty()}")
-        self._original_text_processed()
-
-        # Validation: ensure no line has an empty state stack (logic error if so)
-        for line in self.lines:
-            if len(line.state_stack) == 0:
+            # Validation: ensure no line has an empty state stack (logic error if so)
+            if not self._tail.state_stack:
                 raise RuntimeError(
-                    f"Logic error: Line {line.id} has empty state stack. "
-                    f"Content: '{line.content}'"
+                    f"Logic error: Line {self._tail.id} has empty state stack. "
+                    f"Content: '{self._tail.content}'"
                 )
+            if debug_on:
+                logger.debug("Last line state stack: %s", self._tail.state_stack.pretty())
+        self._original_text_processed()
 
 
 
@@ -6,20 +6,34 @@ Preprocess AsciiDoc files to handle conditional directives.
 import sys
 import logging
 import argparse
+from functools import lru_cache
 from parser import Parsed
-from line_types import Line, State, StateType, StateSubtype, StateStack
+from line_types import Line, State, StateType, StateSubtype, StateStack, NONTEXT_TYPES
 from condmap import ConditionalsMap, ConditionalType
-from typing import Set
+from typing import Set, Tuple
 
 logger = logging.getLogger(__name__)
 
 ATTRIBUTE = "otherprops"
 
+_ROLE_PREFIX = ATTRIBUTE+":"
+_DOTROLE_PREFIX = "."+_ROLE_PREFIX
+
+# the role strings are cached by the values in iteration order, so a cached result
+# is exactly what joining that set would give
+@lru_cache(maxsize=None)
+def _dotroles(values: Tuple[str, ...]) -> str:
+    return ' '.join([_DOTROLE_PREFIX+x for x in values])
+
+@lru_cache(maxsize=None)
+def _attroles(values: Tuple[str, ...]) -> str:
+    return 'role="'+' '.join([_ROLE_PREFIX+x for x in values])+'"'
+
 def dotroles(values: Set[str]) -> str:
-    return ' '.join(["."+ATTRIBUTE+":"+x for x in values])
+    return _dotroles(tuple(values))
 
 def attroles(values: Set[str]) -> str:
-    return 'role="'+' '.join([ATTRIBUTE+":"+x for x in values])+'"'
+    return _attroles(tuple(values))
 
 
 
@@ -29,9 +43,7 @@ def process_conditionals(parsed: Parsed, cond_map: ConditionalsMap):
         """Determine if a state stack includes the list with the given start line ID at any level.
            With except_first_line, if it does but the subtype is FIRST_LINE, refurn False 
         """
-        processing_state_stack = state_stack.duplicate() # do not change the original stack
-        while len(processing_state_stack) > 0:
-            processing_state = processing_state_stack.pop()
+        for processing_state in state_stack.iter_top_down():
             if ((processing_state.type == StateType.LIST_ITEM) and
                 (processing_state.get("list_start_line") == list_start_line)):
                 if except_first_line and (processing_state.subtype == StateSubtype.FIRST_LINE):
@@ -41,39 +53,47 @@ def process_conditionals(parsed: Parsed, cond_map: ConditionalsMap):
         return False
 
 
+    debug_on = logger.isEnabledFor(logging.DEBUG)
     idx = 0
     while idx < len(cond_map.conditionals):
         cond = cond_map.conditionals[idx]
-        logger.debug(f"Processing conditional {idx}: {cond.type.name}, lines {cond.start_id}-{cond.end_id}, values: {', '.join(sorted(cond.values))}")
+        if debug_on:
+            logger.debug("Processing conditional %s: %s, lines %s-%s, values: %s", idx, cond.type.name, cond.start_id, cond.end_id, ', '.join(sorted(cond.values)))
 
-        first_line = parsed.next_line(parsed.line_by_id(cond.start_id))
-        last_line = parsed.previous_line(parsed.line_by_id(cond.end_id))
+        # the lines are looked up once; stepping between them follows the Line links
+        end_line = parsed.line_by_id(cond.end_id)
+        first_line = parsed.line_by_id(cond.start_id).next
+        last_line = end_line.prev
 
         if cond.type == ConditionalType.PARTIAL:
-            logger.debug(f"  Branch: PARTIAL - adding inline roles")
+            if debug_on:
+                logger.debug("  Branch: PARTIAL - adding inline roles")
             first_line.prepend("["+dotroles(cond.values)+"]#")
             last_line.append("#")
         elif cond.type == ConditionalType.PART_START_LIST_ITEM:
-            logger.debug(f"  Branch: PART_START_LIST_ITEM - adding inline roles to partial list item")
+            if debug_on:
+                logger.debug("  Branch: PART_START_LIST_ITEM - adding inline roles to partial list item")
             marker = first_line.state_stack.top().get("marker")
             if not marker:
                 raise RuntimeError(f"Classified as PART_START_LIST_ITEM but no marker found in state, line {first_line.id}")
             content_after_marker = first_line.content[len(marker)+1:] # remove marker and space after it
-            first_line.content = marker+" ["+dotroles(cond.values)+"]#"+content_after_marker
+            first_line.content = f"{marker} [{dotroles(cond.values)}]#{content_after_marker}"
             last_line.append("#")
         elif cond.type == ConditionalType.GROUP_START_LIST_ITEM:
-            logger.debug(f"  Branch: GROUP_START_LIST_ITEM - processing joint list item group")
+            if debug_on:
+                logger.debug("  Branch: GROUP_START_LIST_ITEM - processing joint list item group")
             try:
                 marker = first_line.state_stack.top().get("marker")
                 if not marker:
                     raise RuntimeError(f"Classified as GROUP_START_LIST_ITEM but no marker found in state, line {first_line.id}")
+                marker_end = len(marker)+1 # the same marker, and so the same slice, for the whole group
                 # this is the first one in the group so it does get the marker
-                content_after_marker = first_line.content[len(marker)+1:] # remove marker and space after it
-                first_line.content = marker+" ["+dotroles(cond.values)+"]#"+content_after_marker
+                content_after_marker = first_line.content[marker_end:] # remove marker and space after it
+                first_line.content = f"{marker} [{dotroles(cond.values)}]#{content_after_marker}"
                 last_line.append("#")
 
                 # find the next id after the end line
-                next_line = parsed.next_line(parsed.line_by_id(cond.end_id))
+                next_line = end_line.next
                 next_line_id = next_line.id
 
                 # walk on to find the rest of the group
@@ -83,20 +103,21 @@ def process_conditionals(parsed: Parsed, cond_map: ConditionalsMap):
                        cond_map.conditionals[idx].start_id == next_line_id):
 
                     cond = cond_map.conditionals[idx]
-                    first_line = parsed.next_line(parsed.line_by_id(cond.start_id))
-                    last_line = parsed.previous_line(parsed.line_by_id(cond.end_id))
+                    end_line = parsed.line_by_id(cond.end_id)
+                    first_line = parsed.line_by_id(cond.start_id).next
+                    last_line = end_line.prev
 
                     # error out if this does not have the same marker
                     if first_line.state_stack.top().get("marker") != marker:
                         raise RuntimeError(f"Classified as GROUP_START_LIST_ITEM but marker in state not the same as previous group member, line {first_line.id}")
 
                     # this is a subsequent group member so it gets its marker removed
-                    content_after_marker = first_line.content[len(marker)+1:] # remove marker and space after it
-                    first_line.content = "["+dotroles(cond.values)+"]#"+content_after_marker
+                    content_after_marker = first_line.content[marker_end:] # remove marker and space after it
+                    first_line.content = f"[{dotroles(cond.values)}]#{content_after_marker}"
                     last_line.append("#")
 
                     # Update next_line_id for next iteration
-                    next_line = parsed.next_line(parsed.line_by_id(cond.end_id))
+                    next_line = end_line.next
                     next_line_id = next_line.id
                     idx += 1
 
@@ -110,55 +131,59 @@ def process_conditionals(parsed: Parsed, cond_map: ConditionalsMap):
             # at this time the type is BLOCKS or SINGLE_LIST_ITEM and the processing is block-based
             # the meaning of SINGLE_LIST_ITEM as a separate category is all about
             # detecting groups, which is already done by now
-            logger.debug(f"  Branch: {cond.type.name} - block-based processing")
+            if debug_on:
+                logger.debug("  Branch: %s - block-based processing", cond.type.name)
+            block_roles = attroles(cond.values)
             current_line = first_line
             block_attributes_set = False # flag that we used an existing block attributes line
             while current_line and (current_line.id != cond.end_id): # we process until we hit the endif
                 current_line_top_state = current_line.state_stack.top()
-                if ((current_line_top_state.type, current_line_top_state.subtype) ==
-                    (StateType.BLOCK_PREFIX, StateSubtype.BLOCK_ATTRIBUTES)):
-                    logger.debug(f"    Line {current_line.id}: Adding role to existing BLOCK_ATTRIBUTES")
+                top_type = current_line_top_state.type
+                top_subtype = current_line_top_state.subtype
+                if top_type == StateType.BLOCK_PREFIX and top_subtype == StateSubtype.BLOCK_ATTRIBUTES:
+                    if debug_on:
+                        logger.debug("    Line %s: Adding role to existing BLOCK_ATTRIBUTES", current_line.id)
                     # add role to an existing block attributes line
                     clean_text = current_line.content.rstrip()
                     if not clean_text.endswith("]"):
                         raise RuntimeError(f"Line marked BLOCK_ATTRIBUTES but not ending with ], line {current_line.id}")
-                    current_line.content = clean_text[:-1]+","+attroles(cond.values)+"]" 
+                    current_line.content = clean_text[:-1]+","+block_roles+"]" 
                     block_attributes_set = True
-                elif ((current_line_top_state.type, current_line_top_state.subtype) ==
-                    (StateType.BLOCK_PREFIX, StateSubtype.BLOCK_TITLE)):
-                    logger.debug(f"    Line {current_line.id}: BLOCK_TITLE - creating attributes if needed")
+                elif top_type == StateType.BLOCK_PREFIX and top_subtype == StateSubtype.BLOCK_TITLE:
+                    if debug_on:
+                        logger.debug("    Line %s: BLOCK_TITLE - creating attributes if needed", current_line.id)
                     # for a block title: set block attributes if not present,
                     # also assume attributes carry over to block below
                     if not block_attributes_set:
-                        parsed.create_line_before(current_line, "["+attroles(cond.values)+"]")
+                        parsed.create_line_before(current_line, "["+block_roles+"]")
                     block_attributes_set = True
-                elif ((current_line_top_state.type, current_line_top_state.subtype) ==
-                    (StateType.PARAGRAPH, StateSubtype.FIRST_LINE)):
-                    logger.debug(f"    Line {current_line.id}: PARAGRAPH start - creating attributes if needed")
+                elif top_type == StateType.PARAGRAPH and top_subtype == StateSubtype.FIRST_LINE:
+                    if debug_on:
+                        logger.debug("    Line %s: PARAGRAPH start - creating attributes if needed", current_line.id)
                     # start of paragraph - set block attributes if not present, consume block attributes
                     if not block_attributes_set:
-                        parsed.create_line_before(current_line, "["+attroles(cond.values)+"]")
+                        parsed.create_line_before(current_line, "["+block_roles+"]")
                     block_attributes_set = False
-                elif ((current_line_top_state.type, current_line_top_state.subtype) ==
-                    (StateType.DELIMITED_BLOCK, StateSubtype.START)):
-                    logger.debug(f"    Line {current_line.id}: DELIMITED_BLOCK start - setting attributes if not comment, then jumping over block")
+                elif top_type == StateType.DELIMITED_BLOCK and top_subtype == StateSubtype.START:
+                    if debug_on:
+                        logger.debug("    Line %s: DELIMITED_BLOCK start - setting attributes if not comment, then jumping over block", current_line.id)
                     # start of delimited block - if not a comment, set block attributes if not present,
                     # consume block attributes,
                     # then (in all cases) jump after the end of the block
                     if current_line_top_state.get("delimiter")[0] != "/":
                         if not block_attributes_set:
-                            parsed.create_line_before(current_line, "["+attroles(cond.values)+"]")
+                            parsed.create_line_before(current_line, "["+block_roles+"]")
                         block_attributes_set = False
                     block_end_line_id = current_line_top_state.get("block_end_line")
                     if not block_end_line_id:
                         logger.warning(f"Block end not found from line {current_line.id}, results can be unpredictable")
                     else:
                         block_end_line = parsed.line_by_id(block_end_line_id)
-                        current_line = parsed.next_line(block_end_line)
+                        current_line = block_end_line.next
                         continue # immediately continue the loop as we jumped over the block
-                elif ((current_line_top_state.type, current_line_top_state.subtype) ==
-                    (StateType.LIST_ITEM, StateSubtype.FIRST_LINE)):
-                    logger.debug(f"    Line {current_line.id}: LIST_ITEM start - checking if whole list or just item")
+                elif top_type == StateType.LIST_ITEM and top_subtype == StateSubtype.FIRST_LINE:
+                    if debug_on:
+                        logger.debug("    Line %s: LIST_ITEM start - checking if whole list or just item", current_line.id)
                     # start of list item
                     # here, we must check if the whole list is actually in the conditional
                     #  - but only if this is also the list start line
@@ -167,7 +192,8 @@ def process_conditionals(parsed: Parsed, cond_map: ConditionalsMap):
                     # The logic is we check for whole-list first, and if we conditionalize it we jump over it and continue
                     # If we don't continue the loop we fall through to conditonalizing the item
                     if current_line_top_state.get("list_start_line") == current_line.id:
-                        logger.debug(f"      This is the list start line - checking if entire list is conditioned")
+                        if debug_on:
+                            logger.debug("      This is the list start line - checking if entire list is conditioned")
                         # walk the lines of the list until they are either no longer in the list or we hit the endif
                         # to see if the line is "in the list" we just need to see if LIST_ITEM with this same start line is 
                         # somewhere in its stack
@@ -176,22 +202,21 @@ def process_conditionals(parsed: Parsed, cond_map: ConditionalsMap):
                         complete_list = False
                         line_after_list = None
 
-                        walking_line = parsed.next_line(current_line)
+                        walking_line = current_line.next
                         if not walking_line:
                             raise RuntimeError(f"While processing conditional from line {cond.start_id} we hit EOF - this should not happen")
                         while walking_line.id != cond.end_id:
                             if not walking_line:
                                 raise RuntimeError(f"While processing conditional from line {cond.start_id} we hit EOF - this should not happen")
-                            logger.debug(f"Walking line {walking_line.id}")
-                            if walking_line.state_stack.top().type in [StateType.CONDITIONAL,
-                                                                       StateType.ATTRIBUTE_DEFINITION,
-                                                                       StateType.LINE_COMMENT]:
+                            if debug_on:
+                                logger.debug("Walking line %s", walking_line.id)
+                            if walking_line.state_stack.top().type in NONTEXT_TYPES:
                                 # skip nontext lines
-                                walking_line = parsed.next_line(walking_line)
+                                walking_line = walking_line.next
                                 continue
 
                             if is_in_list(walking_line.state_stack, current_line.id, False):
-                                walking_line = parsed.next_line(walking_line)
+                                walking_line = walking_line.next
                                 continue
 
                             # if we fall through here, we reached a line not in the list before reaching endif
@@ -201,62 +226,69 @@ def process_conditionals(parsed: Parsed, cond_map: ConditionalsMap):
 
                         # If we exited by hitting endif, check what comes after to determine completeness
                         if not complete_list:
-                            logger.debug(f"      Reached endif without finding post-list content - checking after endif")
-                            check_line = parsed.next_line(parsed.line_by_id(cond.end_id))
+                            if debug_on:
+                                logger.debug("      Reached endif without finding post-list content - checking after endif")
+                            check_line = end_line.next
 
                             # Skip blank lines and non-text lines
                             while check_line:
-                                if (check_line.content.strip() == "" or
-                                    check_line.state_stack.top().type in [StateType.CONDITIONAL,
-                                                                          StateType.ATTRIBUTE_DEFINITION,
-                                                                          StateType.LINE_COMMENT]):
-                                    check_line = parsed.next_line(check_line)
+                                if (check_line.is_blank or
+                                    check_line.state_stack.top().type in NONTEXT_TYPES):
+                                    check_line = check_line.next
                                     continue
 
                                 # Found first content line after endif
                                 if is_in_list(check_line.state_stack, current_line.id, False):
-                                    logger.debug(f"        List continues at line {check_line.id} - not complete")
+                                    if debug_on:
+                                        logger.debug("        List continues at line %s - not complete", check_line.id)
                                     complete_list = False
                                 else:
                                     # Different content - complete list
-                                    logger.debug(f"        Line {check_line.id} not part of list - complete")
+                                    if debug_on:
+                                        logger.debug("        Line %s not part of list - complete", check_line.id)
                                     complete_list = True
                                     # Set the line_after_list to the endif line
-                                    line_after_list = parsed.line_by_id(cond.end_id)
+                                    line_after_list = end_line
                                 break
                             else:
                                 # While loop exited normally (check_line became None = EOF)
-                                logger.debug(f"        EOF after endif - complete list")
+                                if debug_on:
+                                    logger.debug("        EOF after endif - complete list")
                                 complete_list = True
                                 # Set the line_after_list to the endif line
-                                line_after_list = parsed.line_by_id(cond.end_id)
+                                line_after_list = end_line
 
                         if complete_list:
-                            logger.debug(f"      Entire list is conditioned - creating block attributes and jumping over list")
+                            if debug_on:
+                                logger.debug("      Entire list is conditioned - creating block attributes and jumping over list")
                             # set block attributes if not present, consume block attributes
                             if not block_attributes_set:
-                                parsed.create_line_before(current_line, "["+attroles(cond.values)+"]")
+                                parsed.create_line_before(current_line, "["+block_roles+"]")
                             block_attributes_set = False
                             current_line = line_after_list
                             continue
                         else:
-                            logger.debug(f"      List extends beyond conditional - will conditionalize just this item")
+                            if debug_on:
+                                logger.debug("      List extends beyond conditional - will conditionalize just this item")
                     # if we reached this point we need to add the slug to conditionalize the list item -
                     #  and then skip everything inside this list item to reach the next list item or something else (or endif)
-                    logger.debug(f"      Adding inline role to individual list item")
-                    marker = current_line.state_stack.top().get("marker")
+                    if debug_on:
+                        logger.debug("      Adding inline role to individual list item")
+                    marker = current_line_top_state.get("marker")
                     if not marker:
                         raise RuntimeError(f"Line classified as LIST_ITEM but no marker found in state, line {current_line.id}")
                     content_after_marker = current_line.content[len(marker)+1:] # remove marker and space after it
-                    current_line.content = marker+" ["+dotroles(cond.values)+"]#{empty}# "+content_after_marker
-                    logger.debug(f"      Walking the contents of the list item")
-                    list_start_line = current_line.state_stack.top().get("list_start_line")
-                    line_after_list_item = parsed.next_line(current_line)
+                    current_line.content = f"{marker} [{dotroles(cond.values)}]#{{empty}}# {content_after_marker}"
+                    if debug_on:
+                        logger.debug("      Walking the contents of the list item")
+                    list_start_line = current_line_top_state.get("list_start_line")
+                    line_after_list_item = current_line.next
                     while (line_after_list_item and (line_after_list_item.id != cond.end_id) and 
                            is_in_list(line_after_list_item.state_stack,list_start_line,True)):  
                             # this call will return False if the line is not in list or is the start of a new item
-                        logger.debug(f"        Walked like {line_after_list_item.id}")
-                        line_after_list_item = parsed.next_line(line_after_list_item)
+                        if debug_on:
+                            logger.debug("        Walked like %s", line_after_list_item.id)
+                        line_after_list_item = line_after_list_item.next
                     
                     if not line_after_list_item:
                         raise RuntimeError(f"While processing conditional from line {cond.start_id} we hit EOF - this should not happen")
@@ -267,31 +299,30 @@ def process_conditionals(parsed: Parsed, cond_map: ConditionalsMap):
                     
 
 
-                elif current_line_top_state.type == StateType.SECTION_HEADER:
-                    logger.debug(f"    Line {current_line.id}: SECTION_HEADER - creating block attributes (uncertain result)")
+                elif top_type == StateType.SECTION_HEADER:
+                    if debug_on:
+                        logger.debug("    Line %s: SECTION_HEADER - creating block attributes (uncertain result)", current_line.id)
                     # we already warned the user this might get unpredictable
                     # now we just create the block attributes
-                    parsed.create_line_before(current_line, "["+attroles(cond.values)+"]")
+                    parsed.create_line_before(current_line, "["+block_roles+"]")
                 else:
-                    logger.debug(f"    Line {current_line.id}: Other type ({current_line_top_state.type.name}) - consuming block attributes if content line")
+                    if debug_on:
+                        logger.debug("    Line %s: Other type (%s) - consuming block attributes if content line", current_line.id, current_line_top_state.type.name)
                     # consume block attributes unless the line is blank or non-text
-                    if not ( current_line.content.strip()== "" or
-                            current_line_top_state.type in [StateType.CONDITIONAL,
-                                                            StateType.LINE_COMMENT,
-                                                            StateType.ATTRIBUTE_DEFINITION]):
+                    if not (current_line.is_blank or top_type in NONTEXT_TYPES):
                         block_attributes_set = False
                 
                 # end of the loop - move current_line to the next line
                 # if we needed to jump we already continued
-                current_line = parsed.next_line(current_line)
+                current_line = current_line.next
             if not current_line:
                 raise RuntimeError(f"While processing block conditional from line {cond.id} hit EOF instead of endif")
         idx += 1
 
 def remove_conditionals(parsed: Parsed, cond_map: ConditionalsMap):
     for cond in cond_map.conditionals:
-        for id in [cond.start_id, cond.end_id]:
-            parsed.remove_by_id(id)
+        parsed.remove_by_id(cond.start_id)
+        parsed.remove_by_id(cond.end_id)
 
 
 def main():
@@ -334,7 +365,7 @@ def main():
     # Read input file
     try:
         with open(input_file, 'r', encoding='utf-8') as f:
-            lines = f.readlines()
+            text = f.read()
     except FileNotFoundError:
         print(f"Error: Input file '{input_file}' not found", file=sys.stderr)
         sys.exit(1)
@@ -343,7 +374,7 @@ def main():
         sys.exit(1)
 
     # Parse the document
-    parsed = Parsed(lines)
+    parsed = Parsed.from_text(text)
 
     # Create conditionals map
     cond_map = ConditionalsMap(parsed, values)
@@ -369,9 +400,7 @@ def main():
     # Write the processed output file (just line contents)
     try:
         with open(output_file, 'w', encoding='utf-8') as f:
-            for line in parsed.lines:
-                f.write(line.content)
-                f.write("\n")
+            f.writelines(line.content + "\n" for line in parsed.lines)
     except IOError as e:
         print(f"Error writing output file: {e}", file=sys.stderr)
         sys.exit(1)
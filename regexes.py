@@ -1,15 +1,14 @@
 import re
-from typing import Optional
 
 CONDITIONAL = re.compile(r'''
       ^                           # start of line
-      (ifdef|ifndef|endif|ifeval) # group 1: directive type
+      (?P<cond_directive>ifdef|ifndef|endif|ifeval) # group 1: directive type
       ::                          # literal double colon
-      ([^\[\]]*)                  # group 2: expression before brackets (possibly empty)
+      (?P<cond_before>[^\[\]]*)    # group 2: expression before brackets (possibly empty)
       \[                          # opening bracket
-      ([^\]]*)                    # group 3: content inside brackets (possibly empty)
+      (?P<cond_inside>[^\]]*)      # group 3: content inside brackets (possibly empty)
       \]                          # closing bracket
-      (.*)                        # group 4: trailing content (comments, whitespace, etc.)
+      (?P<cond_trailing>.*)       # group 4: trailing content (comments, whitespace, etc.)
       $                           # end of line
   ''', re.VERBOSE)
 
@@ -31,63 +30,38 @@ CONDITIONAL = re.compile(r'''
 #           expression = expr_before if expr_before else expr_inside
 
 
-# Typical block delimiter: four-or-more *identical* supported chars:  = * _ - . / +
-#    Line must contain ONLY that delimiter + optional trailing spaces.
-FOUR_MORE_DELIM = re.compile(r'''
+# Any block delimiter, alone on the line with optional trailing whitespace:
+#    the open block delimiter --
+#    four-or-more *identical* supported chars:  = * _ - . / +
+#    a table delimiter  |===  !===  ,===  :===
+# m.group('delimiter_text') is the delimiter without the trailing whitespace
+DELIMITER = re.compile(r'''
     ^                    # start of line
-    (                    # group 1: the delimiter character
-        [=*_\-\./+]         #   exactly one of the supported chars
+    (?P<delimiter_text>  # the delimiter itself, without trailing whitespace
+        --               #   open block delimiter
+      |
+        (?P<delimiter_char>[=*_\-\./+])(?P=delimiter_char){3,}  # four-or-more identical chars
+      |
+        [|!,:]={3,}      #   table delimiter
     )
-    \1{3,}               # that same char at least three more times → 4+
-    [ \t]*               # optional trailing whitespace
+    \s*                  # optional trailing whitespace
     $                    # nothing else
 ''', re.VERBOSE)
 
-# Table opener  |===  !=== ,=== :===
-TABLE_DELIM = re.compile(r'''
-    ^              # start of line
-    ([|!,:])      # group 1: exactly one of |  !  ,  :
-    ={3,}          # followed by at least three equals signs
-    [ \t]*         # optional trailing whitespace
-    $              # nothing else allowed
-''', re.VERBOSE)
-
-# IMPORTANT: the open block delimiter `--` also exists, to be detected by trivial comparison
-
-# Delimiter detector helper
-def is_delimiter(content: str) -> Optional[str]:
-    """
-    Check if content is a delimiter.
-    Returns the delimiter string if it is, None otherwise.
-    """
-    stripped = content.rstrip()
-
-    # Check for open block delimiter (exactly "--")
-    if stripped == "--":
-        return stripped
-
-    # Check for four-or-more delimiter
-    if FOUR_MORE_DELIM.match(stripped):
-        return stripped
-
-    # Check for table delimiter
-    if TABLE_DELIM.match(stripped):
-        return stripped
+# Every character a delimiter can start with (see DELIMITER)
+_DELIMITER_FIRST_CHARS = "=*_-./+|!,:"
+DELIMITER_FIRST_CHARS = frozenset(_DELIMITER_FIRST_CHARS)
 
-    return None
+# First characters of delimiters of verbatim blocks (listing, passthrough, comment, literal)
+# TODO temporarily tables (! : , |) are also considered verbatim blocks
+VERBATIM_DELIMITER_CHARS = frozenset("-+/.!:,|")
 
 def is_delimiter_verbatim(delimiter: str) -> bool:
     """Checks if a delimiter denotes a verbatim block.
     TODO: temporarily tables are considered verbatim blocks
     IMPORTANT: Does NOT check what is passed is actually a valid delimiter"""
-    if delimiter == "--":
-        return False
-    if delimiter[0] in ["-", "+", "/", "."]: 
-        return True
-    # TODO temporarily marking table as verbatim
-    if delimiter[0] in ["!", ":", ",", "|"]: 
-        return True
-    return False
+    # the open block delimiter -- is not verbatim despite starting with -
+    return delimiter != "--" and delimiter[0] in VERBATIM_DELIMITER_CHARS
 
 SECTION_HEADER = re.compile(r'''                                                                                                                                                                                                                                                       
       ^                # start of line                                                                                                                                                                                                                                                   
@@ -120,9 +94,21 @@ SECTION_HEADER = re.compile(r'''
   - =NoSpace (missing required space after =)                                                                                                                                                                                                                                            
   - Lines without equals at the start   """
 
+# Matches exactly the same lines as SECTION_HEADER, without its groups.
+# The lazy title of SECTION_HEADER followed by the optional trailing parts backtracks
+# quadratically on long runs of blanks inside a header line; this form is linear,
+# so it is the one the per-line classification uses
+SECTION_HEADER_LINE = re.compile(r'''
+    ^                # start of line
+    ={1,6}           # section level (1-6 equals signs)
+    [ \t]            # required whitespace after level marker
+    .+               # title, trailing equals and whitespace (further leading whitespace included)
+    $                # end of line
+''', re.VERBOSE)
+
 LIST_ITEM = re.compile(r'''                                                                                                                                                                                                                                                            
       ^                # start of line                                                                                                                                                                                                                                                   
-      (                # group 1: list marker                                                                                                                                                                                                                                            
+      (?P<list_marker> # group 1: list marker                                                                                                                                                                                                                                            
         \*+            #   one or more asterisks (unordered)                                                                                                                                                                                                                             
         |              #   OR                                                                                                                                                                                                                                                            
         \.+            #   one or more dots (ordered)                                                                                                                                                                                                                                    
@@ -189,4 +175,39 @@ ATTRIBUTE_DEFINITION = re.compile(r'''
   Does NOT match:
   - attr-name: value (missing leading colon)
   - :attr name: value (space in attribute name)
-  - Lines that don't start with :     """
\ No newline at end of file
+  - Lines that don't start with :     """
+
+# Every pattern the parser classifies lines with, fused into alternations so that
+# each line needs a single match. The alternatives are in the order the parser checks them;
+# m.lastgroup names the one that matched, and the named groups of each pattern stay available
+_LINE_CLASSIFY_PATTERNS = [
+    # (name, pattern, characters a matching line can start with)
+    ("conditional", CONDITIONAL, "ie"),
+    ("attribute_definition", ATTRIBUTE_DEFINITION, ":"),
+    ("delimiter", DELIMITER, _DELIMITER_FIRST_CHARS),
+    ("list_item", LIST_ITEM, "*."),
+    ("section_header", SECTION_HEADER_LINE, "="),
+]
+
+def _fuse(patterns) -> re.Pattern:
+    return re.compile("|".join(f"(?P<{name}>{pattern.pattern})" for name, pattern, _ in patterns),
+                      re.VERBOSE)
+
+# Dispatch table: first character of a line -> bound match method of the fused regex restricted
+# to the alternatives that can start with that character. Lines whose first character is not
+# a key (most text lines) cannot match any alternative and need no regex match at all
+LINE_CLASSIFY_BY_FIRST_CHAR = {
+    char: _fuse([p for p in _LINE_CLASSIFY_PATTERNS if char in p[2]]).match
+    for char in sorted({c for p in _LINE_CLASSIFY_PATTERNS for c in p[2]})
+}
+
+"""   Usage:
+  match = LINE_CLASSIFY_BY_FIRST_CHAR.get(line[:1])
+  m = match(line) if match else None   # no entry: the line cannot match any pattern
+  kind = m.lastgroup if m else None   # 'conditional', 'list_item', ... or None
+  if kind == 'conditional':
+      directive = m.group('cond_directive')
+  elif kind == 'delimiter':
+      delimiter = m.group('delimiter_text')
+  elif kind == 'list_item':
+      marker = m.group('list_marker')     """
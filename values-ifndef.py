@@ -10,6 +10,9 @@ import re
 from typing import Set
 from preprocess_conditionals import dotroles, attroles
 
+# separators between values: commas and/or whitespace
+VALUE_SEPARATORS = re.compile(r'[,\s]+')
+
 
 def parse_values(args_list):
     """
@@ -23,7 +26,7 @@ def parse_values(args_list):
     all_values = []
     for arg in args_list:
         # Split by comma first, then by spaces
-        parts = re.split(r'[,\s]+', arg)
+        parts = VALUE_SEPARATORS.split(arg)
         all_values.extend([p.strip() for p in parts if p.strip()])
     return set(all_values)
 